@@ -0,0 +1,40 @@
+"""
+Creates the users listed in a CSV file (columns `username`, `email`, `password`).
+
+Example:
+    python provision_users.py analysts.csv
+    python provision_users.py analysts.csv --report report.csv
+"""
+import argparse
+import csv
+
+from stock_analysis import app
+from stock_analysis.ingest import upgrade_database
+from stock_analysis.provisioning import read_users_csv, provision_users
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', help='CSV file with the columns username, email and password')
+    parser.add_argument('--report', help='CSV file where the per-row report is written')
+    args = parser.parse_args()
+
+    with open(args.file, newline='') as f:
+        rows = read_users_csv(f)
+
+    with app.app_context():
+        upgrade_database()
+        report = provision_users(rows)
+
+    for entry in report:
+        if entry['status'] == 'created':
+            print(f"line {entry['line']}: created {entry['username']}")
+        else:
+            print(f"line {entry['line']}: error for {entry['username'] or '?'} - {entry['error']}")
+    created = sum(entry['status'] == 'created' for entry in report)
+    print(f'{created} of {len(report)} users created.')
+
+    if args.report:
+        with open(args.report, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['line', 'username', 'email', 'status', 'error'])
+            writer.writeheader()
+            writer.writerows(report)
@@ -0,0 +1,234 @@
+"""
+Local market-data feed used to load test the price ingestion path.
+
+The feed either replays a CSV file (columns `ticker,price` and optionally `date` as
+`%Y-%m-%d %H:%M:%S`) or generates random-walk ticks for the stocks in the database. The ticks
+are emitted at a fixed rate and written by a pool of writer threads through `ingest_price`,
+i.e. the same path used by the `add_price` route. It runs entirely offline.
+
+At the end, a report with the sustained ingest throughput, the commit latency, the number of
+lock-wait errors and the end-to-end visibility lag (from tick emission until the tick is visible
+to an independent reader) is printed.
+
+Example:
+    python replay_feed.py --rate 2000 --duration 10 --writers 4
+    python replay_feed.py --csv ticks.csv --rate 500
+"""
+import argparse
+import csv
+import datetime
+import math
+import queue
+import random
+import statistics
+import threading
+import time
+
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+from stock_analysis import app, db
+from stock_analysis.ingest import ingest_price, upgrade_database
+from stock_analysis.models import Stock, Diagram
+
+_STOP = object()  # sentinel sent to the writers when the feed is over
+
+
+def random_walk_ticks(stocks, volatility=0.002):
+    """
+    Generates endless random-walk ticks `(stock_id, price, date)` for the given stocks,
+    starting from the latest known price of each stock (or 100 if it has none).
+    """
+    prices = {}
+    for stock in stocks:
+        latest = Diagram.query.filter_by(stock_id=stock.id).order_by(Diagram.date.desc()).first()
+        prices[stock.id] = latest.price if latest else 100.0
+    ids = list(prices)
+    while True:
+        stock_id = random.choice(ids)
+        prices[stock_id] = max(0.01, prices[stock_id] * math.exp(random.gauss(0, volatility)))
+        yield stock_id, round(prices[stock_id], 2), None
+
+
+def csv_ticks(path, stocks, stats=None):
+    """
+    Replays the ticks of a CSV file. Rows with unknown tickers are skipped.
+    Malformed rows (missing cell, bad price or date) are skipped and counted in `stats.input_errors`.
+    """
+    by_ticker = {}
+    for stock in stocks:
+        by_ticker.setdefault(stock.ticker.upper(), stock.id)
+    with open(path, newline='') as f:
+        rows = csv.DictReader(f)
+        for row in rows:
+            try:
+                stock_id = by_ticker.get(row['ticker'].strip().upper())
+                if stock_id is None:
+                    continue
+                date = None
+                if row.get('date'):
+                    date = datetime.datetime.strptime(row['date'], '%Y-%m-%d %H:%M:%S')
+                price = float(row['price'])
+            except (KeyError, AttributeError, TypeError, ValueError) as e:
+                app.logger.warning(f'Skipping line {rows.line_num} of {path}: {e}')
+                if stats is not None:
+                    stats.input_errors += 1
+                continue
+            yield stock_id, price, date
+
+
+class FeedStats:
+    """
+    Thread-safe collection of the measurements taken during a run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.emitted = 0
+        self.committed = []  # (diagram id, emission time)
+        self.commit_latencies = []
+        self.lock_errors = 0
+        self.other_errors = 0
+        self.input_errors = 0  # malformed rows of the CSV, skipped
+        self.observations = []  # (time, max visible diagram id), appended by the reader
+
+    def record_commit(self, diagram_id, emitted_at, latency):
+        with self.lock:
+            self.committed.append((diagram_id, emitted_at))
+            self.commit_latencies.append(latency)
+
+    def record_error(self, error):
+        with self.lock:
+            if isinstance(error, OperationalError) and 'locked' in str(error).lower():
+                self.lock_errors += 1
+            else:
+                self.other_errors += 1
+
+    def visibility_lags(self):
+        """
+        Matches every committed tick with the first reader observation that includes it.
+        """
+        times = [t for t, _ in self.observations]
+        max_ids = [m for _, m in self.observations]
+        lags = []
+        position = 0
+        for diagram_id, emitted_at in sorted(self.committed):
+            while position < len(max_ids) and max_ids[position] < diagram_id:
+                position += 1
+            if position == len(max_ids):
+                break
+            # the reader may have seen it before the writer took its own timestamp
+            lags.append(max(0.0, times[position] - emitted_at))
+        return lags
+
+
+def _percentiles(values):
+    if not values:
+        return 'n/a'
+    if len(values) == 1:
+        return f'p50={values[0] * 1000:.2f}ms max={values[0] * 1000:.2f}ms'
+    q = statistics.quantiles(values, n=100, method='inclusive')  # never beyond the min and max
+    return f'p50={q[49] * 1000:.2f}ms p95={q[94] * 1000:.2f}ms p99={q[98] * 1000:.2f}ms ' \
+           f'max={max(values) * 1000:.2f}ms'
+
+
+def writer(ticks, stats):
+    with app.app_context():
+        while True:
+            tick = ticks.get()
+            if tick is _STOP:
+                break
+            stock_id, price, date, emitted_at = tick
+            started = time.perf_counter()
+            try:
+                diagram_id = ingest_price(stock_id, price, date)
+                stats.record_commit(diagram_id, emitted_at, time.perf_counter() - started)
+            except Exception as e:
+                stats.record_error(e)
+        db.session.remove()
+
+
+def reader(stats, done, interval):
+    """
+    Polls the newest visible price with its own session, independently of the writers.
+    """
+    with app.app_context():
+        while not done.is_set():
+            max_id = db.session.query(func.max(Diagram.id)).scalar() or 0
+            db.session.rollback()  # end the read transaction so the next poll sees new commits
+            stats.observations.append((time.perf_counter(), max_id))
+            time.sleep(interval)
+        db.session.remove()
+
+
+def run_feed(source, rate, duration, writers, poll_interval=0.005, stats=None):
+    stats = stats if stats is not None else FeedStats()
+    ticks = queue.Queue(maxsize=writers * 100)
+    done = threading.Event()
+
+    pool = [threading.Thread(target=writer, args=(ticks, stats), daemon=True) for _ in range(writers)]
+    poller = threading.Thread(target=reader, args=(stats, done, poll_interval), daemon=True)
+    for thread in pool:
+        thread.start()
+    poller.start()
+
+    started = time.perf_counter()
+    for stock_id, price, date in source:
+        now = time.perf_counter()
+        if duration and now - started >= duration:
+            break
+        scheduled = started + stats.emitted / rate
+        if scheduled > now:
+            time.sleep(scheduled - now)
+        ticks.put((stock_id, price, date, time.perf_counter()))  # blocks if the writers fall behind
+        stats.emitted += 1
+
+    for _ in pool:
+        ticks.put(_STOP)
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    time.sleep(poll_interval * 4)  # give the reader a chance to observe the last commits
+    done.set()
+    poller.join()
+    return stats, elapsed
+
+
+def print_report(stats, elapsed, rate):
+    committed = len(stats.committed)
+    print(f'Duration:            {elapsed:.2f}s')
+    print(f'Ticks emitted:       {stats.emitted} (target {rate}/s, offered {stats.emitted / elapsed:.0f}/s)')
+    print(f'Ticks committed:     {committed}')
+    print(f'Ingest throughput:   {committed / elapsed:.0f} ticks/s')
+    print(f'Commit latency:      {_percentiles(stats.commit_latencies)}')
+    print(f'Lock-wait errors:    {stats.lock_errors}')
+    print(f'Other errors:        {stats.other_errors}')
+    print(f'Input errors:        {stats.input_errors}')
+    print(f'Visibility lag:      {_percentiles(stats.visibility_lags())}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--csv', help='CSV file to replay (columns: ticker, price[, date])')
+    parser.add_argument('--rate', default=1000, type=float, help='ticks per second')
+    parser.add_argument('--duration', default=10, type=float, help='seconds to run (0 = until the CSV ends)')
+    parser.add_argument('--writers', default=4, type=int, help='number of writer threads')
+    parser.add_argument('--volatility', default=0.002, type=float, help='random-walk volatility per tick')
+    args = parser.parse_args()
+
+    if not args.csv and not args.duration:
+        parser.error('--duration must be positive when generating random-walk ticks')
+
+    with app.app_context():
+        upgrade_database()
+        stocks = Stock.query.all()
+        if not stocks:
+            app.logger.critical('There are no stocks in the database. Run load_database.py first.')
+            exit(11)
+        stats = FeedStats()
+        if args.csv:
+            source = csv_ticks(args.csv, stocks, stats)
+        else:
+            source = random_walk_ticks(stocks, args.volatility)
+        stats, elapsed = run_feed(source, args.rate, args.duration, args.writers, stats=stats)
+    print_report(stats, elapsed, args.rate)
@@ -1,6 +1,7 @@
 import argparse
 from load_database import reload_database
 from stock_analysis import app
+from stock_analysis.ingest import upgrade_database
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -13,4 +14,7 @@ if __name__ == '__main__':
     if args.reset:  # reset db before running the application
         reload_database()
 
+    with app.app_context():  # a database created by an older version may miss tables
+        upgrade_database()
+
     app.run(debug=args.debug, port=args.port, host=args.host)
@@ -1,5 +1,6 @@
+import os
 from logging.config import dictConfig
-from flask import Flask
+from flask import Flask, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
@@ -37,7 +38,7 @@ dictConfig({
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = '5791628bb0b13ce0c676dfde280ba245'  # change and create your own key
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///site.db')  # the tests use their own DB
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # see more at: https://flask.palletsprojects.com/en/1.1.x/config/#SEND_FILE_MAX_AGE_DEFAULT
@@ -45,6 +46,32 @@ app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0  # option to be used during the deve
 
 app.config['SQLALCHEMY_ECHO'] = False  # option for debugging -- should be set to False for production
 
+# compression of the dynamic responses, see stock_analysis/caching.py
+app.config['COMPRESS_MIN_SIZE'] = 1024  # bytes, smaller responses are sent as they are
+app.config['COMPRESS_LEVEL'] = 6  # gzip compression level
+app.config['COMPRESS_MIMETYPES'] = ['text/html', 'application/json']
+
+# horizons (in days) at which the analyses are scored against the realised prices, see stock_analysis/backtest.py
+app.config['BACKTEST_HORIZONS'] = [7, 30, 90]
+
+# sampling profiler of the requests, see stock_analysis/profiling.py
+app.config['PROFILE_DIR'] = 'profiles'  # where the collapsed stacks (flamegraph input) are written
+app.config['PROFILE_TOKEN'] = None  # if set, requests with the header `X-Profile: <token>` are profiled
+app.config['PROFILE_SAMPLE_RATE'] = 0.0  # fraction of the requests that are profiled (0 = off)
+app.config['PROFILE_INTERVAL'] = 0.001  # seconds between two samples
+app.config['PROFILE_MAX_FILES'] = 200  # the oldest profiles are deleted beyond this number
+
+# bulk provisioning of users (POST /users/bulk), see stock_analysis/provisioning.py
+app.config['PROVISIONING_TOKEN'] = None  # required in the header `X-Provisioning-Token` (None = endpoint disabled)
+app.config['PROVISIONING_MAX_ROWS'] = 500  # maximum number of users per upload
+
+# write-behind mode: the writes are sent to a single writer thread that commits them in batches (group commit)
+# see stock_analysis/writer.py
+app.config['WRITE_BEHIND'] = False
+app.config['WRITE_BEHIND_MAX_BATCH'] = 100  # maximum number of writes committed in one transaction
+app.config['WRITE_BEHIND_MAX_LATENCY'] = 0.005  # seconds a write can wait for its batch to fill up
+app.config['WRITE_BEHIND_TIMEOUT'] = 10  # seconds a request waits for the acknowledgement of its write
+
 # this line is to be used if you are considering uploading large files
 # app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
@@ -67,7 +94,11 @@ def add_header(r):
     """
     Add headers to both force latest IE rendering engine or Chrome Frame,
     and also to cache the rendered page for 10 minutes.
+    Conditional pages (see stock_analysis/caching.py) are kept by the browser, but always revalidated.
     """
+    if g.get('conditional'):
+        r.headers['Cache-Control'] = 'private, no-cache'
+        return r
     r.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     r.headers["Pragma"] = "no-cache"
     r.headers["Expires"] = "0"
@@ -81,4 +112,6 @@ login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message_category = 'info'
 
-from stock_analysis import routes
+# profiling first: the `after_request` functions run in reverse order, so the profile also
+# covers the other ones (e.g. the compression of the response)
+from stock_analysis import profiling, routes
@@ -0,0 +1,193 @@
+"""
+This file contains the backtesting of the analyses.
+
+Each `Analysis` gives a target `price` on `date_posted`. For several horizons (in days), the
+realised price of the stock at `date_posted + horizon` is compared with the price on
+`date_posted` (the entry price) and with the target:
+
+- `return` is the realised return of the stock over the horizon;
+- `hit` is True if the price reached the target in the predicted direction
+  (at or above it for a bullish target, at or below it for a bearish one).
+
+A horizon that goes beyond the last known price of the stock is still pending (None).
+
+The prices are looked up with an as-of join (last price at or before a given time) done with
+`numpy.searchsorted` over all the analyses at once. The results are cached per stock and per
+user, and only the stocks whose data changed since the last refresh are recomputed
+(see `stock_versions` in `stock_analysis.caching`, read from the database).
+"""
+import threading
+
+import numpy as np
+
+from stock_analysis import app, db
+from stock_analysis.caching import stock_versions
+from stock_analysis.models import User, Analysis
+from stock_analysis.series import PriceSeries, to_epoch
+
+KEY_SHIFT = 1 << 34  # seconds; the as-of keys are `stock_id * KEY_SHIFT + epoch seconds`
+DAY = 24 * 60 * 60
+
+
+def _asof(price_keys, price_stocks, values, stocks, keys):
+    """
+    For each key, returns the value of the last price at or before it for the same stock
+    (NaN if there is none). `price_keys` must be sorted.
+    """
+    if len(price_keys) == 0:
+        return np.full(len(keys), np.nan)
+    idx = np.searchsorted(price_keys, keys, side='right') - 1
+    idx_clipped = np.clip(idx, 0, None)
+    found = (idx >= 0) & (price_stocks[idx_clipped] == stocks)
+    return np.where(found, values[idx_clipped], np.nan)
+
+
+def _none_if_nan(value):
+    return None if np.isnan(value) else round(float(value), 6)
+
+
+def run_backtest(stock_ids, horizons):
+    """
+    Backtests all the analyses of the stocks in `stock_ids`.
+    Returns a dict `stock_id -> list of results` (one result per analysis).
+    """
+    analyses = db.session.query(Analysis.id, Analysis.user_id, Analysis.stock_id, Analysis.date_posted,
+                                Analysis.price) \
+        .filter(Analysis.stock_id.in_(stock_ids)).all()
+    results = {stock_id: [] for stock_id in stock_ids}
+    if not analyses:
+        return results
+
+    # concatenating the series in stock order keeps the as-of keys sorted
+    series = PriceSeries.load_many(sorted(stock_ids))
+    arrays = [series[stock_id].to_numpy() for stock_id in sorted(stock_ids)]
+    price_stocks = np.concatenate([np.full(len(series[stock_id]), stock_id, dtype=np.int64)
+                                   for stock_id in sorted(stock_ids)])
+    price_times = np.concatenate([times for times, _ in arrays])
+    price_values = np.concatenate([values for _, values in arrays])
+    price_keys = price_stocks * KEY_SHIFT + price_times
+
+    stocks = np.fromiter((a[2] for a in analyses), dtype=np.int64, count=len(analyses))
+    posted = np.fromiter((to_epoch(a[3]) for a in analyses), dtype=np.int64, count=len(analyses))
+    targets = np.fromiter((a[4] for a in analyses), dtype=np.float64, count=len(analyses))
+
+    entry = _asof(price_keys, price_stocks, price_values, stocks, stocks * KEY_SHIFT + posted)
+    bullish = targets >= entry
+    # time of the last known price of the stock of each analysis
+    last_time = _asof(price_keys, price_stocks, price_times.astype(np.float64), stocks,
+                      stocks * KEY_SHIFT + (KEY_SHIFT - 1))
+
+    columns = {}
+    for horizon in horizons:
+        at = posted + horizon * DAY
+        realised = _asof(price_keys, price_stocks, price_values, stocks, stocks * KEY_SHIFT + at)
+        realised[~(at <= last_time) | np.isnan(entry)] = np.nan  # pending, or no entry price
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = realised / entry - 1
+        hits = np.where(bullish, realised >= targets, realised <= targets)
+        columns[horizon] = (realised, returns, hits)
+
+    for i, (analysis_id, user_id, stock_id, date_posted, target) in enumerate(analyses):
+        outcome = {}
+        for horizon, (realised, returns, hits) in columns.items():
+            if np.isnan(realised[i]):
+                outcome[horizon] = None  # pending, or no entry price
+            else:
+                outcome[horizon] = {'price': _none_if_nan(realised[i]),
+                                    'return': _none_if_nan(returns[i]),
+                                    'hit': bool(hits[i])}
+        results[stock_id].append({'analysis_id': analysis_id,
+                                  'user_id': user_id,
+                                  'stock_id': stock_id,
+                                  'date_posted': date_posted.isoformat(),
+                                  'target': target,
+                                  'entry_price': _none_if_nan(entry[i]),
+                                  'horizons': outcome})
+    return results
+
+
+class BacktestCache:
+    """
+    Cache of the backtest results per stock and per user, refreshed incrementally.
+    A refresh builds new dicts and lists and swaps them in at the end, so the readers
+    (other request threads) never see them change while they use them.
+    """
+
+    def __init__(self, horizons):
+        self.horizons = tuple(horizons)
+        self._lock = threading.Lock()
+        self._versions = {}  # stock_id -> version stamp used for its results
+        self._by_stock = {}  # stock_id -> results
+        self._by_user = {}  # user_id -> results
+
+    def refresh(self):
+        """
+        Recomputes the stocks whose prices or analyses changed since the last refresh.
+        Returns the ids of the recomputed stocks.
+        """
+        with self._lock:
+            versions = stock_versions()
+            stock_ids = list(versions)
+            stale = [stock_id for stock_id in stock_ids if self._versions.get(stock_id) != versions[stock_id]]
+            removed = set(self._by_stock) - set(stock_ids)
+            if not stale and not removed:
+                return []
+
+            fresh = run_backtest(stale, self.horizons) if stale else {}
+            changed = set(stale) | removed
+            by_stock = {stock_id: results for stock_id, results in self._by_stock.items()
+                        if stock_id not in changed}
+            by_stock.update(fresh)
+
+            # replace the results of the changed stocks in the per-user cache
+            by_user = {}
+            for user_id, results in self._by_user.items():
+                kept = [r for r in results if r['stock_id'] not in changed]
+                if kept:
+                    by_user[user_id] = kept
+            for results in fresh.values():
+                for result in results:
+                    by_user.setdefault(result['user_id'], []).append(result)
+
+            self._versions = {stock_id: version for stock_id, version in self._versions.items()
+                              if stock_id not in changed}
+            self._versions.update((stock_id, versions[stock_id]) for stock_id in fresh)
+            self._by_stock, self._by_user = by_stock, by_user
+            app.logger.debug(f'Backtest refreshed for the stocks {sorted(changed)}')
+            return sorted(changed)
+
+    def by_stock(self, stock_id):
+        self.refresh()
+        return self._by_stock.get(stock_id, [])
+
+    def by_user(self, user_id):
+        self.refresh()
+        return self._by_user.get(user_id, [])
+
+    def leaderboard(self, horizon):
+        """
+        Ranks the users by their hit rate at `horizon` (only the evaluated analyses count).
+        """
+        if horizon not in self.horizons:
+            raise ValueError(f'Unknown horizon {horizon}. Use one of {self.horizons}.')
+        self.refresh()
+        by_user = self._by_user  # not modified after a refresh has swapped it in
+        usernames = dict(db.session.query(User.id, User.username))
+        board = []
+        for user_id, results in by_user.items():
+            outcomes = [r['horizons'][horizon] for r in results if r['horizons'][horizon] is not None]
+            if not outcomes:
+                continue
+            hits = sum(outcome['hit'] for outcome in outcomes)
+            board.append({'user_id': user_id,
+                          'username': usernames.get(user_id),
+                          'analyses': len(results),
+                          'evaluated': len(outcomes),
+                          'hits': hits,
+                          'hit_rate': round(hits / len(outcomes), 4),
+                          'average_return': round(sum(o['return'] for o in outcomes) / len(outcomes), 6)})
+        board.sort(key=lambda entry: (-entry['hit_rate'], -entry['evaluated'], entry['username'] or ''))
+        return board
+
+
+backtests = BacktestCache(app.config['BACKTEST_HORIZONS'])
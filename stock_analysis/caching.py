@@ -0,0 +1,208 @@
+"""
+This file contains the HTTP caching of the dynamic pages and the compression of the responses.
+
+Views decorated with `conditional` get an ETag derived from version stamps read from the
+database, so an unchanged page is answered with a `304 Not Modified` after one small query,
+before the view runs (no template rendering). A stamp combines:
+
+- the newest row ids (e.g. `max(Diagram.id)` of a stock), read through the indexes, which reveal
+  new rows whatever process or connection inserted them (the feed, a second worker, ...);
+- the `DataVersion` counters, bumped in the same transaction as every update or deletion made
+  through the ORM, since those do not change the newest ids.
+
+The random token of the process is only a salt of the ETag. `Last-Modified` is the time of the
+last counted update; the 304 is decided on the ETag only, since inserted rows carry no reliable
+modification time.
+"""
+import datetime
+import functools
+import gzip
+import hashlib
+import secrets
+
+from flask import request, session, g
+from flask_login import current_user
+from sqlalchemy import event, func, select, cast, literal
+from sqlalchemy.orm import Session
+
+from stock_analysis import app, db
+from stock_analysis.models import User, Stock, Analysis, Diagram, DataVersion
+
+try:  # brotli is optional, gzip is used when it is not installed
+    import brotli
+except ImportError:
+    brotli = None
+
+_token = secrets.token_hex(4)  # salt of the ETags
+ALL = '*'  # counter bumped by the bulk statements, part of every stamp
+
+
+def _version(key):
+    return select(DataVersion.version).where(DataVersion.key == key).scalar_subquery()
+
+
+def _max_id(model, *criteria):
+    return select(func.max(model.id)).where(*criteria).scalar_subquery()
+
+
+# what each key of a page depends on: ('stock', id) is a stock page, 'stocks' the list of stocks, etc.
+def _stamp_columns(key):
+    if key == 'stocks':  # the list of stocks shows the latest prices
+        return [_max_id(Stock), _max_id(Diagram)], ['stocks']
+    if key == 'analyses':
+        return [_max_id(Analysis)], ['analyses']
+    if key == 'users':
+        return [], ['users']
+    kind, key_id = key
+    if kind == 'stock':
+        return [_max_id(Diagram, Diagram.stock_id == key_id), _max_id(Analysis, Analysis.stock_id == key_id)], \
+               [f'stock:{key_id}']
+    if kind == 'analysis':
+        return [], [f'analysis:{key_id}']
+    raise ValueError(f'Unknown cache key {key!r}')
+
+
+def stamp(keys):
+    """
+    Returns the combined version of `keys` and the time of their last counted update (or None),
+    read with a single query.
+    """
+    columns, counters = [], [ALL]
+    for key in keys:
+        key_columns, key_counters = _stamp_columns(key)
+        columns += key_columns
+        counters += key_counters
+    columns += [_version(counter) for counter in counters]
+    last_modified = select(func.max(DataVersion.date_modified)) \
+        .where(DataVersion.key.in_(counters)).scalar_subquery()
+    row = db.session.execute(select(*columns, last_modified)).one()
+    return '.'.join(str(value) for value in row[:-1]), row[-1]
+
+
+def stock_versions():
+    """
+    Returns the version of the prices and analyses of every stock, `stock_id -> tuple`,
+    with a single query. The newest ids are correlated subqueries answered by the `stock_id`
+    indexes, so the cost grows with the number of stocks, not with the number of prices.
+    """
+    counter_key = literal('stock:') + cast(Stock.id, db.String)
+    query = select(Stock.id,
+                   _max_id(Diagram, Diagram.stock_id == Stock.id),
+                   _max_id(Analysis, Analysis.stock_id == Stock.id),
+                   _version(counter_key),
+                   _version(ALL))
+    return {row[0]: tuple(row[1:]) for row in db.session.execute(query)}
+
+
+def bump(connection, keys):
+    """
+    Increments the `DataVersion` counters of `keys`, on the connection of the current transaction.
+    """
+    table = DataVersion.__table__
+    now = datetime.datetime.utcnow()
+    for key in sorted(keys):
+        result = connection.execute(table.update()
+                                    .where(table.c.key == key)
+                                    .values(version=table.c.version + 1, date_modified=now))
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(key=key, version=1, date_modified=now))
+
+
+# counters bumped when a row of each model is updated or deleted
+def _diagram_keys(diagram):
+    return [f'stock:{diagram.stock_id}', 'stocks']
+
+
+def _analysis_keys(analysis):
+    return [f'stock:{analysis.stock_id}', f'analysis:{analysis.id}', 'analyses']
+
+
+def _stock_keys(stock):
+    return [f'stock:{stock.id}', 'stocks']
+
+
+def _user_keys(user):
+    return ['users']
+
+
+_model_keys = {Diagram: _diagram_keys, Analysis: _analysis_keys, Stock: _stock_keys, User: _user_keys}
+
+
+@event.listens_for(Session, 'after_flush')
+def _on_flush(db_session, flush_context):
+    # new rows are seen through the newest ids, only updates and deletions are counted
+    keys = set()
+    for target in db_session.dirty:
+        if type(target) in _model_keys and db_session.is_modified(target):
+            keys.update(_model_keys[type(target)](target))
+    for target in db_session.deleted:
+        if type(target) in _model_keys:
+            keys.update(_model_keys[type(target)](target))
+    if keys:
+        bump(db_session.connection(), keys)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _on_bulk_change(context):
+    # bulk statements (e.g. `query.update()`) do not tell which rows changed
+    if context.mapper.class_ in _model_keys:
+        bump(context.session.connection(), ['users'] if context.mapper.class_ is User else [ALL])
+
+
+def conditional(keys):
+    """
+    Decorator that answers GET requests with `304 Not Modified` when the client already has
+    the current version of the page. `keys` receives the arguments of the view and returns
+    the version keys the page depends on.
+    The validators also depend on the URL and on the logged in user.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # pages showing flashed messages are never cached
+            if request.method != 'GET' or '_flashes' in session:
+                return view(*args, **kwargs)
+            version, last_modified = stamp(keys(**kwargs))
+            user_id = current_user.get_id() if current_user.is_authenticated else 0
+            key = f'{_token}|{user_id}|{version}|{request.full_path}'.encode('utf-8')
+            etag = hashlib.sha1(key).hexdigest()[:20]
+
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            g.conditional = True
+            return response
+        return wrapper
+    return decorator
+
+
+@app.after_request
+def compress(response):
+    """
+    Compresses the large HTML and JSON responses with brotli (if available) or gzip.
+    """
+    if (response.status_code != 200
+            or response.direct_passthrough  # files are streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in app.config['COMPRESS_MIMETYPES']):
+        return response
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encodings = request.accept_encodings
+    if brotli is not None and encodings['br']:
+        response.set_data(brotli.compress(data))
+        response.headers['Content-Encoding'] = 'br'
+    elif encodings['gzip']:
+        response.set_data(gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
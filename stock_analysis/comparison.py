@@ -0,0 +1,96 @@
+"""
+This file contains the aligned comparison of several stocks.
+
+The prices of all the requested stocks are fetched with a single query (see `PriceSeries`)
+and sampled onto a common time grid (forward-filling the last known price, including the one
+in effect at the start of the window), so that the series can be compared and charted side by side.
+"""
+import numpy as np
+
+from stock_analysis.models import Stock
+from stock_analysis.series import PriceSeries, to_epoch
+
+MAX_POINTS = 2000  # upper bound of points per series in the grid
+MODES = ('price', 'indexed', 'normalised')
+
+
+def _grid(start, end, step):
+    """
+    Returns the common time grid as an array of epoch seconds.
+    The step (in seconds) is widened if needed so that the grid has at most `MAX_POINTS` points.
+    """
+    min_step = -(-(end - start) // (MAX_POINTS - 1))  # ceiling division
+    step = max(step or 0, min_step, 1)
+    return np.arange(start, end + 1, step, dtype=np.int64), step
+
+
+def _align(times, prices, grid):
+    """
+    Samples a sorted price series onto the grid, forward-filling the last known price.
+    Grid points before the first price are NaN.
+    """
+    idx = np.searchsorted(times, grid, side='right') - 1
+    aligned = prices[np.clip(idx, 0, None)] if len(prices) else np.full(len(grid), np.nan)
+    return np.where(idx >= 0, aligned, np.nan)
+
+
+def _rescale(values, mode):
+    """
+    Rescales an aligned series according to `mode`:
+    `price` keeps the prices, `indexed` sets the first known price to 100,
+    and `normalised` returns the performance relative to the first known price.
+    """
+    if mode == 'price':
+        return values
+    known = np.flatnonzero(~np.isnan(values))
+    if len(known) == 0 or values[known[0]] == 0:
+        return np.full(len(values), np.nan)
+    base = values[known[0]]
+    if mode == 'indexed':
+        return values / base * 100
+    return values / base - 1
+
+
+def _to_list(values):
+    return [None if np.isnan(v) else v for v in np.round(values, 4).tolist()]
+
+
+def compare_stocks(stock_ids, startdate=None, enddate=None, mode='indexed', step=None):
+    """
+    Builds a columnar comparison of the stocks in `stock_ids`.
+
+    The result contains the grid timestamps (`t`, epoch seconds), the stock metadata and one
+    list of values per stock (`series`), in the same order as `stocks`.
+    Raises a `LookupError` if none of the stocks exist.
+    """
+    if mode not in MODES:
+        raise ValueError(f'Unknown comparison mode {mode!r}. Use one of {", ".join(MODES)}.')
+
+    stocks = Stock.query.filter(Stock.id.in_(stock_ids)).all()
+    stocks = sorted(stocks, key=lambda s: stock_ids.index(s.id))  # keep the requested order
+    if not stocks:
+        raise LookupError('None of the selected stocks exist.')
+    ids = [s.id for s in stocks]
+
+    prices = PriceSeries.load_many(ids, startdate, enddate, include_previous=True)
+    loaded = [prices[stock_id] for stock_id in ids if len(prices[stock_id])]
+
+    start = to_epoch(startdate) if startdate is not None else min((p.times[0] for p in loaded), default=0)
+    end = to_epoch(enddate) if enddate is not None else max((p.times[-1] for p in loaded), default=0)
+    grid, step = _grid(start, max(start, end), step)
+
+    series = []
+    for stock_id in ids:
+        times, values = prices[stock_id].to_numpy()
+        aligned = _align(times, values, grid)
+        series.append(_to_list(_rescale(aligned, mode)))
+
+    return {
+        'mode': mode,
+        'start': start,
+        'end': end,
+        'step': int(step),
+        't': grid.tolist(),
+        'stocks': [{'id': s.id, 'name': s.name, 'ticker': s.ticker} for s in stocks],
+        'series': series,
+    }
@@ -0,0 +1,83 @@
+"""
+This file contains the price ingestion path.
+
+Every new price, whether it is typed in by a user (`add_price`) or produced by a feed, goes
+through `ingest_price`, so that all writers share the same transaction handling.
+"""
+from sqlalchemy import inspect
+
+from stock_analysis import app, db
+from stock_analysis.models import Diagram, LatestPrice, LATEST_PRICE_TRIGGER
+from stock_analysis.writer import run_write
+
+
+def ingest_price(stock_id, price, date=None):
+    """
+    Inserts a new price for the stock `stock_id` and commits it (see `run_write`).
+    If `date` is None, the current time is used (the column default).
+    Returns the id of the new `Diagram` row. On failure, the exception is raised again to the caller.
+    """
+    def write(session):
+        new_price = Diagram(stock_id=stock_id, price=price)
+        if date is not None:
+            new_price.date = date
+        session.add(new_price)
+        session.flush()  # assigns the id
+        return new_price.id
+
+    try:
+        return run_write(write)
+    except Exception:
+        app.logger.error(f'Error while adding the price {price} to the stock {stock_id}')
+        raise
+
+
+def rebuild_latest_prices():
+    """
+    Recomputes the `LatestPrice` of every stock from all its prices, e.g. for a database
+    created before the table existed. New prices keep it up to date on their own.
+    """
+    latest = {}
+    rows = db.session.query(Diagram.stock_id, Diagram.date, Diagram.price).order_by(Diagram.stock_id, Diagram.date)
+    for stock_id, date, price in rows:
+        current = latest.get(stock_id)
+        if current is None:
+            latest[stock_id] = LatestPrice(stock_id=stock_id, price=price, date=date)
+            continue
+        if date.date() > current.date.date():
+            current.previous_close = current.price
+        current.price = price
+        current.date = date
+
+    def write(session):
+        session.query(LatestPrice).delete()
+        session.add_all(latest.values())
+
+    run_write(write)
+
+
+def upgrade_database():
+    """
+    Brings a database created by an older version of the application up to date: creates the
+    missing tables, indexes and triggers, and fills `LatestPrice` if its table did not exist yet.
+    Existing tables and data are left as they are. It runs at start up (see run.py) and with
+    `flask upgrade-db`.
+    """
+    existing = set(inspect(db.engine).get_table_names())
+    db.create_all()  # only creates the missing tables
+    for table in db.metadata.sorted_tables:
+        if table.name in existing:
+            for index in table.indexes:
+                index.create(bind=db.engine, checkfirst=True)
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.begin() as connection:
+            connection.execute(LATEST_PRICE_TRIGGER)
+    if 'diagram' in existing and LatestPrice.__tablename__ not in existing:
+        rebuild_latest_prices()
+        app.logger.info('The latest prices were rebuilt.')
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create the missing tables, indexes and triggers of an existing database."""
+    upgrade_database()
@@ -5,6 +5,7 @@ from dataclasses import dataclass
 import datetime
 from stock_analysis import db, login_manager
 from flask_login import UserMixin
+from sqlalchemy import event, DDL
 
 
 
@@ -52,7 +53,7 @@ class Analysis(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship(User, backref=db.backref('analyses', lazy=True))
 
-    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), nullable=False)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), nullable=False, index=True)
     stock = db.relationship(Stock, backref=db.backref('analyses', lazy=True, order_by='Analysis.date_posted.desc()'))
 
     def __repr__(self):
@@ -66,7 +67,93 @@ class Diagram(db.Model):
     price = db.Column(db.Float, nullable=False)
 
     stock = db.relationship(Stock, backref=db.backref('diagrams'), lazy=True)
-    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), nullable=False)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), nullable=False, index=True)
 
     def __repr__(self):
-        return f"<Diagram(date='{self.date}', price='{self.price}', stock='{self.stock_id}')>"
\ No newline at end of file
+        return f"<Diagram(date='{self.date}', price='{self.price}', stock='{self.stock_id}')>"
+
+
+@dataclass
+class LatestPrice(db.Model):
+    """
+    Latest price of each stock, maintained on every price insert (see `LATEST_PRICE_TRIGGER`),
+    so that the current price and market value of all the stocks can be listed in one read.
+    """
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), primary_key=True)
+    price = db.Column(db.Float, nullable=False)
+    date = db.Column(db.DateTime, nullable=False)
+    previous_close = db.Column(db.Float)  # last price of the previous day with prices
+
+    stock = db.relationship(Stock, backref=db.backref('latest_price', uselist=False, lazy=True))
+
+    @property
+    def day_change(self):
+        if self.previous_close is None:
+            return None
+        return self.price - self.previous_close
+
+    @property
+    def day_change_percent(self):
+        if not self.previous_close:
+            return None
+        return (self.price / self.previous_close - 1) * 100
+
+    def __repr__(self):
+        return f"<LatestPrice(stock='{self.stock_id}', date='{self.date}', price='{self.price}', previous_close='{self.previous_close}')>"
+
+
+# Keeps `LatestPrice` up to date in the same statement as the new price, whoever inserts it (the ORM,
+# a bulk insert, another process). Prices older than the latest one (e.g. history being back-filled)
+# do not change it, and when the day changes, the latest price becomes the previous close.
+LATEST_PRICE_TRIGGER = DDL("""
+CREATE TRIGGER IF NOT EXISTS diagram_latest_price AFTER INSERT ON diagram
+BEGIN
+    INSERT INTO latest_price (stock_id, price, date, previous_close)
+    VALUES (NEW.stock_id, NEW.price, NEW.date, NULL)
+    ON CONFLICT (stock_id) DO UPDATE SET
+        previous_close = CASE WHEN date(excluded.date) > date(latest_price.date)
+                              THEN latest_price.price ELSE latest_price.previous_close END,
+        price = excluded.price,
+        date = excluded.date
+    WHERE excluded.date >= latest_price.date;
+END
+""")
+event.listen(Diagram.__table__, 'after_create', LATEST_PRICE_TRIGGER.execute_if(dialect='sqlite'))
+
+
+@event.listens_for(Diagram, 'after_insert')
+def _update_latest_price(mapper, connection, diagram):
+    """
+    Keeps `LatestPrice` up to date on the databases without the trigger (not SQLite), where
+    the prices must therefore be inserted through the ORM (see `ingest_price`).
+    The row is locked, so that concurrent prices of the same stock are applied one at a time.
+    """
+    if connection.dialect.name == 'sqlite':
+        return  # done by LATEST_PRICE_TRIGGER
+    table = LatestPrice.__table__
+    current = connection.execute(table.select().where(table.c.stock_id == diagram.stock_id)
+                                 .with_for_update()).first()
+    if current is None:
+        connection.execute(table.insert().values(stock_id=diagram.stock_id,
+                                                 price=diagram.price,
+                                                 date=diagram.date))
+    elif diagram.date >= current.date:
+        # when the day changes, the latest price becomes the previous close
+        previous_close = current.price if diagram.date.date() > current.date.date() else current.previous_close
+        connection.execute(table.update()
+                           .where(table.c.stock_id == diagram.stock_id)
+                           .values(price=diagram.price, date=diagram.date, previous_close=previous_close))
+
+
+@dataclass
+class DataVersion(db.Model):
+    """
+    Version counters of the data that new rows alone do not reveal (updates and deletions),
+    bumped in the same transaction as the change. See stock_analysis/caching.py.
+    """
+    key = db.Column(db.String(40), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    date_modified = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)  # UTC
+
+    def __repr__(self):
+        return f"<DataVersion(key='{self.key}', version='{self.version}', date_modified='{self.date_modified}')>"
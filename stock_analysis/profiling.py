@@ -0,0 +1,181 @@
+"""
+This file contains a sampling profiler for the requests.
+
+A request is profiled when it carries the header `X-Profile: <PROFILE_TOKEN>` or when it is
+picked at random (`PROFILE_SAMPLE_RATE`). While the request runs, a sampler thread records the
+stack of the request thread every `PROFILE_INTERVAL` seconds. When the thread is executing SQL
+or rendering a template, a `[sql]` or `[template]` frame is added on top of the stack.
+
+The samples are written to `PROFILE_DIR` in the collapsed-stack format (one `frame;frame;... count`
+line per stack), which can be turned into a flamegraph with `flamegraph.pl` or opened in
+https://www.speedscope.app. The response gets a `Server-Timing` header with the total, SQL and
+template times, and an `X-Profile-File` header with the name of the file. Only the last
+`PROFILE_MAX_FILES` files are kept.
+
+When a request is not profiled, the only cost is one check in `before_request` and one
+attribute lookup per SQL statement.
+"""
+import collections
+import datetime
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+
+from flask import request, g, before_render_template, template_rendered
+from sqlalchemy import event
+
+from stock_analysis import app, db
+
+_local = threading.local()  # the profile of the request running in the current thread, if any
+
+
+class RequestProfile:
+    """
+    Samples the stack of one thread until it is stopped.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.in_sql = False
+        self.in_template = 0  # templates can include other templates
+        self.started = time.perf_counter()
+        self.duration = None
+        self._done = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name='request-profiler', daemon=True)
+        self._sampler.start()
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            stack.reverse()
+            if self.in_template:
+                stack.append('[template]')
+            if self.in_sql:
+                stack.append('[sql]')
+            self.stacks[';'.join(stack)] += 1
+
+    def stop(self):
+        self._done.set()
+        self._sampler.join()
+        self.duration = time.perf_counter() - self.started
+
+    def save(self, directory, name, max_files=None):
+        """
+        Writes the collapsed stacks to `directory` and returns the file name.
+        If `max_files` is given, the oldest files beyond that number are deleted.
+        """
+        os.makedirs(directory, exist_ok=True)
+        timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        filename = f'{timestamp}-{name}.collapsed'
+        with open(os.path.join(directory, filename), 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        if max_files is not None:
+            _prune(directory, max_files)
+        return filename
+
+
+def _prune(directory, max_files):
+    # the names start with the timestamp, so they sort from the oldest to the newest
+    profiles = sorted(name for name in os.listdir(directory) if name.endswith('.collapsed'))
+    for name in profiles[:max(0, len(profiles) - max_files)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:  # removed by another request
+            pass
+
+
+def _profile_requested():
+    token = app.config['PROFILE_TOKEN']
+    if token and hmac.compare_digest(request.headers.get('X-Profile', '').encode('utf-8'), token.encode('utf-8')):
+        return True  # constant-time comparison, so that the token cannot be guessed from the timing
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+
+@app.before_request
+def start_profile():
+    if _profile_requested():
+        g.profile = _local.profile = RequestProfile(threading.get_ident(), app.config['PROFILE_INTERVAL'])
+
+
+@app.after_request
+def stop_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    _local.profile = None
+    profile.stop()
+    try:
+        filename = profile.save(app.config['PROFILE_DIR'], request.endpoint or 'unknown',
+                                app.config['PROFILE_MAX_FILES'])
+        response.headers['X-Profile-File'] = filename
+    except OSError as e:
+        app.logger.error('Error while saving the request profile.')
+        app.logger.exception(e)
+    response.headers['Server-Timing'] = f'total;dur={profile.duration * 1000:.1f}, ' \
+                                        f'sql;dur={profile.sql_time * 1000:.1f}, ' \
+                                        f'template;dur={profile.template_time * 1000:.1f}'
+    return response
+
+
+@app.teardown_request
+def discard_profile(exception):
+    # the request failed before `after_request`: stop the sampler anyway
+    profile = g.pop('profile', None)
+    if profile is not None:
+        _local.profile = None
+        profile.stop()
+
+
+@event.listens_for(db.engine, 'before_cursor_execute')
+def _before_sql(conn, cursor, statement, parameters, context, executemany):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.in_sql = True
+        conn.info['profile_sql_started'] = time.perf_counter()
+
+
+@event.listens_for(db.engine, 'after_cursor_execute')
+def _after_sql(conn, cursor, statement, parameters, context, executemany):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.in_sql = False
+        profile.sql_time += time.perf_counter() - conn.info.pop('profile_sql_started', time.perf_counter())
+
+
+def _before_template(sender, template, context, **extra):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        if not profile.in_template:
+            g.profile_template_started = time.perf_counter()
+        profile.in_template += 1
+
+
+def _after_template(sender, template, context, **extra):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None and profile.in_template:
+        profile.in_template -= 1
+        if not profile.in_template:
+            profile.template_time += time.perf_counter() - g.pop('profile_template_started')
+
+
+try:
+    before_render_template.connect(_before_template, app)
+    template_rendered.connect(_after_template, app)
+except RuntimeError:  # blinker is not installed: the [template] frames and time are not recorded
+    app.logger.info('Signals are not available, the profiler will not measure the template rendering.')
@@ -0,0 +1,125 @@
+"""
+This file contains the bulk provisioning of users (e.g. a whole desk of analysts at once).
+
+Compared with registering the users one by one, the uniqueness of all the usernames and emails
+is checked with a single query, the passwords are hashed in parallel (bcrypt releases the GIL
+while hashing, so a thread pool uses all the cores), and all the users are inserted in one
+transaction. Each input row gets an entry in the report, with its status and error (if any).
+"""
+import csv
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from email_validator import validate_email, EmailNotValidError
+from sqlalchemy import or_
+
+from stock_analysis import app, db, bcrypt
+from stock_analysis.models import User
+from stock_analysis.writer import run_write
+
+
+class TooManyRowsError(Exception):
+    """
+    The file has more users than allowed in one upload.
+    """
+
+
+def read_users_csv(f, max_rows=None):
+    """
+    Reads the users from a CSV file with the columns `username`, `email` and `password`.
+    Returns a list of `(line number, row)`. Raises a `TooManyRowsError` if there are more than
+    `max_rows` rows, and a `csv.Error` if the file is not valid CSV.
+    """
+    reader = csv.DictReader(f)
+    rows = []
+    for row in reader:
+        if max_rows is not None and len(rows) >= max_rows:
+            raise TooManyRowsError(f'The file has more than {max_rows} users.')
+        rows.append((reader.line_num, row))
+    return rows
+
+
+def _validate(row):
+    """
+    Applies the same rules as the `RegistrationForm`. Returns an error message or None.
+    """
+    username = (row.get('username') or '').strip()
+    if not 2 <= len(username) <= 20:
+        return 'The username must have between 2 and 20 characters.'
+    try:
+        validate_email((row.get('email') or '').strip(), check_deliverability=False)
+    except EmailNotValidError as e:
+        return f'Invalid email: {e}'
+    if not row.get('password'):
+        return 'The password is missing.'
+    return None
+
+
+def _hash_password(password):
+    return bcrypt.generate_password_hash(password).decode('utf-8')
+
+
+def provision_users(rows):
+    """
+    Creates the users given as `(line number, row)` (see `read_users_csv`).
+    Returns the report: one dict per row with `line`, `username`, `email`, `status`
+    (`created` or `error`) and `error`.
+    """
+    report = []
+    candidates = []
+    seen_usernames, seen_emails = set(), set()
+    for line, row in rows:
+        entry = {'line': line,
+                 'username': (row.get('username') or '').strip(),
+                 'email': (row.get('email') or '').strip(),
+                 'status': 'error',
+                 'error': _validate(row)}
+        report.append(entry)
+        if entry['error'] is not None:
+            continue
+        if entry['username'] in seen_usernames:
+            entry['error'] = 'This username appears more than once in the file.'
+        elif entry['email'] in seen_emails:
+            entry['error'] = 'This email appears more than once in the file.'
+        else:
+            seen_usernames.add(entry['username'])
+            seen_emails.add(entry['email'])
+            candidates.append((entry, row['password']))
+
+    # uniqueness of the whole batch against the database, in one query
+    if candidates:
+        existing = db.session.query(User.username, User.email) \
+            .filter(or_(User.username.in_(sorted(seen_usernames)), User.email.in_(sorted(seen_emails)))).all()
+        taken_usernames = {username for username, _ in existing}
+        taken_emails = {email for _, email in existing}
+        remaining = []
+        for entry, password in candidates:
+            if entry['username'] in taken_usernames:
+                entry['error'] = 'This username is taken.'
+            elif entry['email'] in taken_emails:
+                entry['error'] = 'This email is taken.'
+            else:
+                remaining.append((entry, password))
+        candidates = remaining
+
+    if not candidates:
+        return report
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        hashed = list(pool.map(_hash_password, [password for _, password in candidates]))
+    users = [User(username=entry['username'], email=entry['email'], password=hashed_password)
+             for (entry, _), hashed_password in zip(candidates, hashed)]
+
+    try:
+        run_write(lambda session: session.add_all(users))
+    except Exception as e:
+        app.logger.critical(f'Error while provisioning {len(users)} users.')
+        app.logger.exception(e)
+        for entry, _ in candidates:
+            entry['error'] = 'The users could not be saved. Try again later.'
+        return report
+
+    for entry, _ in candidates:
+        entry['status'] = 'created'
+    app.logger.info(f'{len(candidates)} users provisioned.')
+    return report
@@ -1,26 +1,44 @@
+import csv
 import datetime
+import hmac
+import io
 import os
 import secrets
 from PIL import Image
-from flask import render_template, url_for, flash, redirect, request, abort
+from flask import render_template, url_for, flash, redirect, request, abort, jsonify
 
 import stock_analysis.models
 from stock_analysis import app, db, bcrypt
 from stock_analysis.forms import RegistrationForm, LoginForm, UpdateAccountForm, AnalysisForm, StockForm, DiagramForm
-from stock_analysis.models import User, Analysis, Stock, Diagram
+from stock_analysis.models import User, Analysis, Stock, LatestPrice
+from stock_analysis.backtest import backtests
+from stock_analysis.caching import conditional
+from stock_analysis.comparison import compare_stocks
+from stock_analysis.ingest import ingest_price
+from stock_analysis.provisioning import read_users_csv, provision_users, TooManyRowsError
+from stock_analysis.series import PriceSeries
+from stock_analysis.writer import run_write, group_writer
 from flask_login import login_user, current_user, logout_user, login_required
 
 
 @app.route("/")
 @app.route("/home")
+@conditional(lambda: ['stocks', 'analyses'])
 def home():
-    stocks = Stock.query.order_by(Stock.name).all()
+    stocks = stocks_with_prices()
     analyses = []
     if current_user.is_authenticated:
         analyses = Analysis.query.filter_by(user_id=current_user.id).all()
     return render_template('home.html', stocks=stocks, analyses=analyses)
 
 
+def stocks_with_prices():
+    """
+    Returns all the stocks with their latest price (None if they have no prices), in one query.
+    """
+    return db.session.query(Stock, LatestPrice).outerjoin(LatestPrice).order_by(Stock.name).all()
+
+
 @app.route("/about")
 def about():
     return render_template('about.html', title='About')
@@ -35,18 +53,16 @@ def register():
         hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
         # create a new instance of the class User -- lecture 6
         user = User(username=form.username.data, email=form.email.data, password=hashed_password)
-        db.session.add(user)  # adds the user to the database
         try:  # error handling
             # transaction management - databases
-            # the changes to the database are only persisted once you commit the session
-            db.session.commit()
+            # the changes to the database are only persisted once the write is committed
+            run_write(lambda session: session.add(user))  # adds the user to the database
             app.logger.debug('New user created successfully.')  # error handling
             flash('Your account has been created! You are now able to log in.', 'success')  # show message to user
             return redirect(url_for('login'))
         except Exception as e:
             # transaction management - databases
-            # if something goes wrong with the transaction, you need to rollback the session
-            db.session.rollback()
+            # if something goes wrong with the transaction, `run_write` rolls back the session
             app.logger.critical(f'Error while creating the user {user}')  # error handling
             app.logger.exception(e)  # error handling
             flash('The system encountered a problem while creating your account. Try again later.', 'danger')
@@ -117,19 +133,18 @@ def save_raw_picture(form_picture):
 def account():
     form = UpdateAccountForm()
     if form.validate_on_submit():
+        changes = {'username': form.username.data, 'email': form.email.data}
         if form.picture.data:
             # (un)comment the lines below to get the desired effect
             # picture_file = save_compressed_picture(form.picture.data)  # this function saves a compressed picture
             picture_file = save_raw_picture(form.picture.data)  # this function saves the exact file
-            current_user.image_file = picture_file
-        current_user.username = form.username.data
-        current_user.email = form.email.data
+            changes['image_file'] = picture_file
+        user_id = current_user.id
         try:
-            db.session.commit()
+            run_write(lambda session: session.query(User).filter_by(id=user_id).update(changes))
             flash('Your account has been updated!', 'success')
             return redirect(url_for('account'))
         except Exception as e:
-            db.session.rollback()
             app.logger.critical(f'Error while updating your account. {current_user}')
             app.logger.exception(e)
             flash('There was an error while updating your account. Try again later.', 'danger')
@@ -150,9 +165,8 @@ def create_stock():
                               number_of_shares=form.number_of_shares.data,
                               ticker=form.ticker.data.upper()
                               )
-        db.session.add(created_stock)
         try:
-            db.session.commit()
+            run_write(lambda session: session.add(created_stock))
             flash('Your stock has been created!', 'success')
             return redirect(url_for('home'))
         except:
@@ -177,12 +191,11 @@ def create_analysis(stock_id):
                                     earnings=form.earnings.data,
                                     p_e=form.p_e.data,
                                     market_cap=form.market_cap.data,
-                                    user=current_user,
-                                    stock=current_stock
+                                    user_id=current_user.id,
+                                    stock_id=current_stock.id
                                     )
-        db.session.add(new_analysis)
         try:
-            db.session.commit()
+            run_write(lambda session: session.add(new_analysis))
             flash('Your analysis has been created!', 'success')
             return redirect(f'/stock/{current_stock.id}')
         except:
@@ -196,36 +209,49 @@ def create_analysis(stock_id):
 
 
 @app.route("/stock/<int:stock_id>", methods=['GET', 'POST'])
+@conditional(lambda stock_id: [('stock', stock_id), 'users'])
 def stock(stock_id):
     current_stock = Stock.query.get_or_404(stock_id)
-    diagrams = []
-    if 'startdate' in request.args and 'enddate' in request.args:
-        startdate = datetime.datetime.strptime(request.args['startdate'], '%Y-%m-%d')
-        enddate = datetime.datetime.strptime(request.args['enddate'], '%Y-%m-%d')
-        diagrams = Diagram.query.filter_by(stock_id=current_stock.id).filter(Diagram.date >=startdate).filter(Diagram.date <= enddate).all()
-    else:
-        diagrams = Diagram.query.filter_by(stock_id=current_stock.id).order_by(Diagram.date).all()
+    diagrams = PriceSeries.load(current_stock.id, *_price_range())
     return render_template('stock.html',
                            stock=current_stock,
                            diagrams=diagrams
                            )
 
+
+def _price_range():
+    """
+    Returns the (startdate, enddate) given in the query string, or (None, None) if not both are given.
+    """
+    if 'startdate' in request.args and 'enddate' in request.args:
+        startdate = datetime.datetime.strptime(request.args['startdate'], '%Y-%m-%d')
+        enddate = datetime.datetime.strptime(request.args['enddate'], '%Y-%m-%d')
+        return startdate, enddate
+    return None, None
+
+
+@app.route("/api/stock/<int:stock_id>/prices")
+@conditional(lambda stock_id: [('stock', stock_id)])
+def api_prices(stock_id):
+    current_stock = Stock.query.get_or_404(stock_id)
+    try:
+        return jsonify(PriceSeries.load(current_stock.id, *_price_range()).to_dict())
+    except ValueError:  # bad dates
+        abort(400)
+
 @app.route("/diagram/<int:stock_id>/new-price", methods=['GET', 'POST'])
 @login_required
 def add_price(stock_id):
     stock= Stock.query.get_or_404(stock_id)
     form = DiagramForm()
     if form.validate_on_submit():
-        new_price = Diagram(price=form.price.data,
-                            stock=stock)
-        db.session.add(new_price)
         try:
-            db.session.commit()
+            ingest_price(stock.id, form.price.data)
             flash('Your price has been added!', 'success')
             return redirect(f'/stock/{stock.id}')
         except:
             flash('Something went wrong, please try again', 'danger')
-            return redirect(url_for('add_price'))
+            return redirect(url_for('add_price', stock_id=stock.id))
 
     return render_template('add_price.html',
                            title='Add Price',
@@ -235,6 +261,7 @@ def add_price(stock_id):
 
 
 @app.route("/analysis/<int:analysis_id>/", methods=['GET', 'POST'])
+@conditional(lambda analysis_id: [('analysis', analysis_id), 'users'])
 def analysis(analysis_id):
     current_analysis = Analysis.query.get_or_404(analysis_id)
     return render_template('analysis.html', analysis=current_analysis)
@@ -285,3 +312,139 @@ def delete_analysis(analysis_id):
     return redirect(url_for('stock', stock_id=analysis_to_delete.stock.id))
 
 
+def _comparison_args():
+    """
+    Reads the comparison parameters from the query string.
+    Stocks can be given either as repeated `stock_id` parameters or as a comma-separated `ids`.
+    """
+    stock_ids = request.args.getlist('stock_id', type=int)
+    if 'ids' in request.args:
+        stock_ids += [int(i) for i in request.args['ids'].split(',') if i.strip().isdigit()]
+    startdate = enddate = None
+    if request.args.get('startdate'):
+        startdate = datetime.datetime.strptime(request.args['startdate'], '%Y-%m-%d')
+    if request.args.get('enddate'):
+        enddate = datetime.datetime.strptime(request.args['enddate'], '%Y-%m-%d')
+    return dict(stock_ids=list(dict.fromkeys(stock_ids)),
+                startdate=startdate,
+                enddate=enddate,
+                mode=request.args.get('mode', 'indexed'),
+                step=request.args.get('step', type=int))
+
+
+@app.route("/compare")
+def compare():
+    stocks = Stock.query.order_by(Stock.name).all()
+    selected = []
+    comparison = None
+    try:
+        args = _comparison_args()
+        selected = args['stock_ids']
+        if selected:
+            comparison = compare_stocks(**args)
+    except ValueError as e:  # bad dates or unknown mode
+        flash(str(e), 'danger')
+    except LookupError as e:  # unknown stocks
+        flash(str(e), 'danger')
+    return render_template('compare.html',
+                           title='Compare',
+                           stocks=stocks,
+                           selected=selected,
+                           comparison=comparison)
+
+
+@app.route("/api/compare")
+def api_compare():
+    try:
+        args = _comparison_args()
+        if not args['stock_ids']:
+            abort(400)
+        return jsonify(compare_stocks(**args))
+    except ValueError:  # bad dates or unknown mode
+        abort(400)
+    except LookupError:  # none of the stocks exist
+        abort(404)
+
+
+@app.route("/metrics/writes")
+def write_metrics():
+    return jsonify(group_writer.metrics())
+
+
+@app.route("/api/stocks")
+@conditional(lambda: ['stocks'])
+def api_stocks():
+    stocks = []
+    for current_stock, latest in stocks_with_prices():
+        stocks.append({'id': current_stock.id,
+                       'name': current_stock.name,
+                       'ticker': current_stock.ticker,
+                       'number_of_shares': current_stock.number_of_shares,
+                       'price': latest.price if latest else None,
+                       'date': latest.date.isoformat() if latest else None,
+                       'day_change': latest.day_change if latest else None,
+                       'market_value': latest.price * current_stock.number_of_shares if latest else None})
+    return jsonify(stocks)
+
+
+@app.route("/leaderboard")
+def leaderboard():
+    horizon = request.args.get('horizon', app.config['BACKTEST_HORIZONS'][0], type=int)
+    if horizon not in backtests.horizons:
+        abort(404)
+    return render_template('leaderboard.html',
+                           title='Leaderboard',
+                           horizon=horizon,
+                           horizons=backtests.horizons,
+                           board=backtests.leaderboard(horizon))
+
+
+@app.route("/api/leaderboard")
+def api_leaderboard():
+    horizon = request.args.get('horizon', app.config['BACKTEST_HORIZONS'][0], type=int)
+    try:
+        return jsonify(horizon=horizon, leaderboard=backtests.leaderboard(horizon))
+    except ValueError:  # unknown horizon
+        abort(400)
+
+
+@app.route("/api/backtest/stock/<int:stock_id>")
+def api_backtest_stock(stock_id):
+    Stock.query.get_or_404(stock_id)
+    return jsonify(backtests.by_stock(stock_id))
+
+
+@app.route("/api/backtest/user/<int:user_id>")
+def api_backtest_user(user_id):
+    User.query.get_or_404(user_id)
+    return jsonify(backtests.by_user(user_id))
+
+
+@app.route("/users/bulk", methods=['POST'])
+@login_required
+def bulk_users():
+    """
+    Creates the users of the uploaded CSV (`file` field, or the body of a `text/csv` request)
+    and returns the per-row report.
+    Only the holders of the `PROVISIONING_TOKEN` (header `X-Provisioning-Token`) can use it.
+    """
+    token = app.config['PROVISIONING_TOKEN']
+    sent = request.headers.get('X-Provisioning-Token', '')
+    if not token or not hmac.compare_digest(sent.encode('utf-8'), token.encode('utf-8')):
+        abort(403)
+    if 'file' in request.files:
+        data = request.files['file'].read()
+    elif request.mimetype == 'text/csv':
+        data = request.get_data()
+    else:
+        abort(400)
+    try:
+        content = data.decode('utf-8-sig')
+        rows = read_users_csv(io.StringIO(content, newline=''), app.config['PROVISIONING_MAX_ROWS'])
+    except TooManyRowsError:
+        abort(413)
+    except (UnicodeDecodeError, csv.Error):  # not a UTF-8 CSV file
+        abort(400)
+    report = provision_users(rows)
+    created = sum(entry['status'] == 'created' for entry in report)
+    return jsonify(created=created, errors=len(report) - created, report=report)
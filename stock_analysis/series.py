@@ -0,0 +1,124 @@
+"""
+This file contains `PriceSeries`, a read-only price series stored in compact typed arrays.
+
+Loading prices as `Diagram` instances builds one ORM object per price and keeps all of them in
+the identity map of the session. `PriceSeries` instead runs a core query on the two needed
+columns and stores the timestamps (epoch seconds) and the prices in `array` objects, i.e. 16
+bytes per price. It can be iterated like a list of diagrams (`point.date`, `point.price`) by the
+templates, and exposed as numpy arrays (without copy) for the analytics.
+"""
+import collections
+import datetime
+from array import array
+
+import numpy as np
+from sqlalchemy import select, func
+
+from stock_analysis import db
+from stock_analysis.models import Diagram
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+Point = collections.namedtuple('Point', ['date', 'price'])
+
+
+def to_epoch(date):
+    """
+    Converts a (naive) datetime to seconds since the epoch.
+    """
+    return int((date - EPOCH).total_seconds())
+
+
+def from_epoch(seconds):
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+class PriceSeries:
+    """
+    Prices of one stock sorted by date, with a resolution of one second.
+    """
+    __slots__ = ('stock_id', 'times', 'prices')
+
+    def __init__(self, stock_id, times=None, prices=None):
+        self.stock_id = stock_id
+        self.times = times if times is not None else array('q')  # epoch seconds
+        self.prices = prices if prices is not None else array('d')
+
+    @staticmethod
+    def _query(stock_ids, startdate=None, enddate=None):
+        table = Diagram.__table__
+        query = select(table.c.stock_id, table.c.date, table.c.price).where(table.c.stock_id.in_(stock_ids))
+        if startdate is not None:
+            query = query.where(table.c.date >= startdate)
+        if enddate is not None:
+            query = query.where(table.c.date <= enddate)
+        return query.order_by(table.c.stock_id, table.c.date)
+
+    @staticmethod
+    def _previous_query(stock_ids, startdate):
+        # last price strictly before `startdate` of each stock (greatest date per group, joined back)
+        table = Diagram.__table__
+        last = select(table.c.stock_id, func.max(table.c.date).label('date')) \
+            .where(table.c.stock_id.in_(stock_ids), table.c.date < startdate) \
+            .group_by(table.c.stock_id).subquery()
+        return select(table.c.stock_id, table.c.date, table.c.price) \
+            .join_from(table, last, (table.c.stock_id == last.c.stock_id) & (table.c.date == last.c.date))
+
+    @classmethod
+    def load(cls, stock_id, startdate=None, enddate=None):
+        """
+        Loads the prices of the stock `stock_id` between `startdate` and `enddate` (if given).
+        """
+        return cls.load_many([stock_id], startdate, enddate)[stock_id]
+
+    @classmethod
+    def load_many(cls, stock_ids, startdate=None, enddate=None, include_previous=False):
+        """
+        Loads the prices of several stocks with a single query.
+        Returns a dict `stock_id -> PriceSeries` (empty series for stocks without prices).
+        With `include_previous`, each series also starts with the last price before `startdate`,
+        i.e. the price in effect at `startdate`.
+        """
+        series = {stock_id: cls(stock_id) for stock_id in stock_ids}
+        if include_previous and startdate is not None:
+            for stock_id, date, price in db.session.execute(cls._previous_query(stock_ids, startdate)):
+                series[stock_id].times.append(to_epoch(date))
+                series[stock_id].prices.append(price)
+        current = None
+        for stock_id, date, price in db.session.execute(cls._query(stock_ids, startdate, enddate)):
+            if current is None or current.stock_id != stock_id:
+                current = series[stock_id]
+            current.times.append(to_epoch(date))
+            current.prices.append(price)
+        return series
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __iter__(self):
+        for seconds, price in zip(self.times, self.prices):
+            yield Point(from_epoch(seconds), price)
+
+    def __getitem__(self, index):
+        """
+        Returns the `Point` at `index`, or a new `PriceSeries` for a slice.
+        """
+        if isinstance(index, slice):
+            return PriceSeries(self.stock_id, self.times[index], self.prices[index])
+        return Point(from_epoch(self.times[index]), self.prices[index])
+
+    def to_numpy(self):
+        """
+        Returns the timestamps (int64 epoch seconds) and prices (float64) as numpy arrays
+        sharing the memory of the series.
+        """
+        return np.frombuffer(self.times, dtype=np.int64), np.frombuffer(self.prices, dtype=np.float64)
+
+    def to_dict(self):
+        """
+        Columnar representation, e.g. for the chart API.
+        """
+        return {'stock_id': self.stock_id, 't': self.times.tolist(), 'price': self.prices.tolist()}
+
+    def __repr__(self):
+        return f"<PriceSeries(stock='{self.stock_id}', prices='{len(self)}')>"
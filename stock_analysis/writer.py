@@ -0,0 +1,200 @@
+"""
+This file contains the database write path.
+
+By default, `run_write` executes a write in the current session and commits it right away.
+When `WRITE_BEHIND` is enabled, the writes are instead sent to a single writer thread that
+groups many small writes into one transaction (group commit), so that SQLite pays one
+fsync per batch instead of one per write. The caller still waits for the commit, so an
+acknowledgement is only returned once the write is durable.
+
+A write is a function that receives the session to use, e.g.:
+
+    def write(session):
+        session.add(user)
+
+It must not commit, and it must not use objects attached to the request session
+(pass ids instead), since in write-behind mode it runs in the session of the writer thread.
+If it needs to return a generated id, it should flush the session first. The value returned
+should be a plain value (id, number, string), not an ORM instance.
+"""
+import atexit
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from stock_analysis import app, db
+
+_STOP = object()  # sentinel used to stop the writer thread
+
+
+class GroupCommitWriter:
+    """
+    Single writer thread that commits the submitted writes in batches.
+    A batch is closed when it reaches `max_batch` writes or when the first write in it
+    has waited `max_latency` seconds.
+    """
+
+    def __init__(self, flask_app, max_batch=100, max_latency=0.005):
+        self.app = flask_app
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self._batch_sizes = collections.deque(maxlen=1000)
+        self._commit_times = collections.deque(maxlen=1000)
+        self._ack_latencies = collections.deque(maxlen=1000)
+        self.batches = 0
+        self.writes = 0
+        self.errors = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='group-commit-writer', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """
+        Commits the pending writes and stops the writer thread.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._queue.put(_STOP)
+                self._thread.join()
+            self._thread = None
+
+    def submit(self, write):
+        """
+        Queues `write` and returns a `Future` that is resolved once its batch is committed.
+        """
+        self.start()
+        future = Future()
+        self._queue.put((write, future, time.perf_counter()))
+        return future
+
+    def _next_batch(self):
+        """
+        Blocks for the first write, then collects more until the batch is full or the
+        latency window has elapsed. Returns the batch and whether the writer must stop.
+        The writes are claimed when they enter the batch: the ones already cancelled by a
+        caller that timed out are dropped, and the others can no longer be cancelled.
+        """
+        first = self._queue.get()
+        if first is _STOP:
+            return [], True
+        batch = [first] if first[1].set_running_or_notify_cancel() else []
+        deadline = time.perf_counter() + self.max_latency
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            if item[1].set_running_or_notify_cancel():
+                batch.append(item)
+        return batch, False
+
+    def _run(self):
+        with self.app.app_context():
+            stop = False
+            while not stop:
+                batch, stop = self._next_batch()
+                if batch:
+                    started = time.perf_counter()
+                    self._commit(batch)
+                    self._record(batch, time.perf_counter() - started)
+            db.session.remove()
+
+    def _commit(self, batch):
+        """
+        Runs all the writes of the batch in one transaction. If the transaction fails,
+        the writes are retried one by one, so that only the failing ones get an error.
+        """
+        session = db.session
+        try:
+            results = [write(session) for write, _, _ in batch]
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            if len(batch) == 1:
+                with self._metrics_lock:
+                    self.errors += 1
+                batch[0][1].set_exception(e)
+            else:
+                for item in batch:
+                    self._commit([item])
+            return
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def _record(self, batch, commit_time):
+        now = time.perf_counter()
+        with self._metrics_lock:
+            self.batches += 1
+            self.writes += len(batch)
+            self._batch_sizes.append(len(batch))
+            self._commit_times.append(commit_time)
+            self._ack_latencies.extend(now - submitted for _, _, submitted in batch)
+
+    def metrics(self):
+        """
+        Returns the counters and the batch-size and latency statistics (in milliseconds)
+        over the last 1000 batches/writes.
+        """
+        def summary(values, scale=1):
+            values = sorted(values)
+            if not values:
+                return None
+            return {'avg': round(sum(values) / len(values) * scale, 3),
+                    'p50': round(values[len(values) // 2] * scale, 3),
+                    'p95': round(values[int(len(values) * 0.95)] * scale, 3),
+                    'max': round(values[-1] * scale, 3)}
+
+        with self._metrics_lock:
+            return {'enabled': bool(self.app.config.get('WRITE_BEHIND')),
+                    'max_batch': self.max_batch,
+                    'max_latency_ms': self.max_latency * 1000,
+                    'pending': self._queue.qsize(),
+                    'batches': self.batches,
+                    'writes': self.writes,
+                    'errors': self.errors,
+                    'batch_size': summary(self._batch_sizes),
+                    'commit_ms': summary(self._commit_times, 1000),
+                    'ack_latency_ms': summary(self._ack_latencies, 1000)}
+
+
+group_writer = GroupCommitWriter(app,
+                                 max_batch=app.config['WRITE_BEHIND_MAX_BATCH'],
+                                 max_latency=app.config['WRITE_BEHIND_MAX_LATENCY'])
+atexit.register(group_writer.stop)
+
+
+def run_write(write):
+    """
+    Executes `write` and commits it, either in the current session or through the group-commit
+    writer (if `WRITE_BEHIND` is enabled). Returns the value returned by `write`.
+    On failure, the exception is raised to the caller (and the session is rolled back).
+    In write-behind mode, a `TimeoutError` means that the write was cancelled before being
+    committed; once its batch has started, the caller waits for the outcome of the commit.
+    """
+    if app.config['WRITE_BEHIND']:
+        future = group_writer.submit(write)
+        try:
+            return future.result(timeout=app.config['WRITE_BEHIND_TIMEOUT'])
+        except TimeoutError:
+            if future.cancel():
+                raise  # the write was still queued: it will never be committed
+            return future.result()  # its batch is being committed: wait for the real outcome
+    try:
+        result = write(db.session)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result
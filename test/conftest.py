@@ -0,0 +1,24 @@
+"""
+Fixtures for the unit tests. The tests run on their own SQLite file, never on site.db.
+"""
+import os
+import tempfile
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+
+import pytest
+
+from stock_analysis import app, db
+
+
+@pytest.fixture
+def database():
+    """
+    Empty database, inside an application context.
+    """
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield db
+        db.session.remove()
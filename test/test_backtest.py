@@ -0,0 +1,80 @@
+"""
+Unit tests of the backtesting of the analyses (stock_analysis/backtest.py).
+"""
+import datetime
+import sqlite3
+
+import pytest
+
+from stock_analysis import app, db
+from stock_analysis.backtest import run_backtest, BacktestCache
+from stock_analysis.models import User, Stock, Analysis, Diagram
+
+
+def day(n):
+    return datetime.datetime(2024, 1, 1) + datetime.timedelta(days=n)
+
+
+@pytest.fixture
+def analyses(database):
+    user = User(username='analyst', email='analyst@test.com', password='x')
+    stock = Stock(name='TESTED', number_of_shares=10, ticker='TEST')
+    db.session.add_all([user, stock,
+                        Diagram(date=day(0), price=100, stock=stock),
+                        Diagram(date=day(10), price=110, stock=stock),
+                        Diagram(date=day(40), price=90, stock=stock)])
+    bullish = Analysis(title='Up', content='Up', price=105, earnings=1, p_e=1, market_cap=1,
+                       date_posted=day(1), user=user, stock=stock)
+    too_early = Analysis(title='Early', content='Early', price=50, earnings=1, p_e=1, market_cap=1,
+                         date_posted=day(-30), user=user, stock=stock)  # no price yet
+    db.session.add_all([bullish, too_early])
+    db.session.commit()
+    return stock, bullish, too_early
+
+
+def test_asof_join(analyses):
+    stock, bullish, too_early = analyses
+    results = {r['analysis_id']: r for r in run_backtest([stock.id], (7, 30, 90))[stock.id]}
+
+    result = results[bullish.id]
+    assert result['entry_price'] == 100  # last price at or before the posting
+    assert result['horizons'][7] == {'price': 100, 'return': 0, 'hit': False}
+    assert result['horizons'][30] == {'price': 110, 'return': 0.1, 'hit': True}
+    assert result['horizons'][90] is None  # after the last known price: pending
+
+    result = results[too_early.id]
+    assert result['entry_price'] is None
+    assert result['horizons'] == {7: None, 30: None, 90: None}
+
+
+def test_cache_is_refreshed_after_an_external_insert(analyses):
+    stock, bullish, _ = analyses
+    cache = BacktestCache((7, 30, 90))
+    assert cache.refresh() == [stock.id]
+    assert cache.refresh() == []
+    assert cache.by_user(bullish.user_id)[0]['horizons'][90] is None
+
+    path = app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+    with sqlite3.connect(path) as connection:  # e.g. the replay feed
+        connection.execute('INSERT INTO diagram (date, price, stock_id) VALUES (?, ?, ?)',
+                           (day(100).isoformat(' '), 120, stock.id))
+
+    assert cache.refresh() == [stock.id]
+    outcome = [r for r in cache.by_user(bullish.user_id) if r['analysis_id'] == bullish.id][0]['horizons'][90]
+    assert outcome == {'price': 90, 'return': -0.1, 'hit': False}
+
+
+def test_refresh_does_not_modify_the_published_results(analyses):
+    stock, bullish, _ = analyses
+    cache = BacktestCache((7, 30, 90))
+    results = cache.by_user(bullish.user_id)
+    by_user = cache._by_user
+    assert len(results) == 2
+
+    other = User(username='other', email='other@test.com', password='x')
+    db.session.add(Analysis(title='Down', content='Down', price=80, earnings=1, p_e=1, market_cap=1,
+                            date_posted=day(2), user=other, stock=stock))
+    db.session.commit()
+
+    assert len(cache.leaderboard(30)) == 2
+    assert len(results) == 2 and by_user == {bullish.user_id: results}  # swapped, not modified
@@ -0,0 +1,68 @@
+"""
+Unit tests of the conditional GET and the compression (stock_analysis/caching.py).
+"""
+import datetime
+import sqlite3
+
+import pytest
+
+from stock_analysis import app, db
+from stock_analysis.models import User, Stock, Analysis
+
+
+@pytest.fixture
+def stock(database):
+    user = User(username='analyst', email='analyst@test.com', password='x')
+    stock = Stock(name='CACHED', number_of_shares=10, ticker='CACH')
+    analysis = Analysis(title='Title', content='Content', price=10, earnings=1, p_e=1, market_cap=1,
+                        user=user, stock=stock)
+    db.session.add_all([user, stock, analysis])
+    db.session.commit()
+    return stock
+
+
+def get(url, etag=None, **headers):
+    if etag:
+        headers['If-None-Match'] = etag
+    with app.test_client() as client:
+        return client.get(url, headers=headers)
+
+
+def test_unchanged_page_is_not_modified(stock):
+    first = get(f'/stock/{stock.id}')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    assert get(f'/stock/{stock.id}', etag).status_code == 304
+    assert get(f'/stock/{stock.id}?startdate=2024-01-01&enddate=2024-02-01', etag).status_code == 200
+
+
+def test_insert_from_another_connection_invalidates_the_page(stock):
+    etag = get(f'/stock/{stock.id}').headers['ETag']
+
+    path = app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+    with sqlite3.connect(path) as connection:  # e.g. the feed, or another worker
+        connection.execute('INSERT INTO diagram (date, price, stock_id) VALUES (?, ?, ?)',
+                           (datetime.datetime(2024, 1, 1).isoformat(' '), 12.5, stock.id))
+
+    response = get(f'/stock/{stock.id}', etag)
+    assert response.status_code == 200
+    assert b'12.5' in response.data
+    assert response.headers['ETag'] != etag
+
+
+def test_update_invalidates_the_page(stock):
+    analysis = Analysis.query.first()
+    etag = get(f'/analysis/{analysis.id}/').headers['ETag']
+
+    analysis.content = 'Updated content'
+    db.session.commit()
+
+    response = get(f'/analysis/{analysis.id}/', etag)
+    assert response.status_code == 200
+    assert b'Updated content' in response.data
+
+
+def test_large_pages_are_compressed(stock):
+    response = get(f'/stock/{stock.id}', **{'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
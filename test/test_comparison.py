@@ -0,0 +1,60 @@
+"""
+Unit tests of the aligned comparison of stocks (stock_analysis/comparison.py).
+"""
+import datetime
+import math
+
+import numpy as np
+import pytest
+
+from stock_analysis import app, db
+from stock_analysis.comparison import _align, _rescale, compare_stocks
+from stock_analysis.models import Stock, Diagram
+
+DAY = 24 * 60 * 60
+
+
+def test_align_forward_fills():
+    times = np.array([10, 20, 30], dtype=np.int64)
+    prices = np.array([1.0, 2.0, 3.0])
+    aligned = _align(times, prices, np.array([5, 10, 15, 25, 40], dtype=np.int64))
+    assert math.isnan(aligned[0])  # before the first price
+    assert aligned[1:].tolist() == [1.0, 1.0, 2.0, 3.0]
+    assert np.isnan(_align(times[:0], prices[:0], np.array([10, 20]))).all()
+
+
+def test_rescale():
+    values = np.array([np.nan, 50.0, 75.0, 25.0])
+    assert _rescale(values, 'price') is values
+    assert _rescale(values, 'indexed')[1:].tolist() == [100.0, 150.0, 50.0]
+    assert _rescale(values, 'normalised')[1:].tolist() == [0.0, 0.5, -0.5]
+    assert np.isnan(_rescale(np.array([np.nan, np.nan]), 'indexed')).all()
+    assert np.isnan(_rescale(np.array([0.0, 1.0]), 'indexed')).all()  # no base to divide by
+
+
+@pytest.fixture
+def stocks(database):
+    a = Stock(name='A', number_of_shares=10, ticker='A')
+    b = Stock(name='B', number_of_shares=10, ticker='B')
+    db.session.add_all([a, b,
+                        Diagram(date=datetime.datetime(2024, 2, 1), price=10, stock=a),
+                        Diagram(date=datetime.datetime(2024, 1, 29), price=78, stock=b),
+                        Diagram(date=datetime.datetime(2024, 2, 5), price=85, stock=b)])
+    db.session.commit()
+    return a, b
+
+
+def test_series_start_with_the_price_in_effect(stocks):
+    a, b = stocks
+    comparison = compare_stocks([a.id, b.id], datetime.datetime(2024, 2, 1), datetime.datetime(2024, 2, 10),
+                                mode='price', step=DAY)
+    assert len(comparison['t']) == 10
+    assert comparison['series'][0] == [10.0] * 10
+    assert comparison['series'][1] == [78.0] * 4 + [85.0] * 6
+
+
+def test_unknown_stocks(stocks):
+    with app.test_client() as client:
+        assert client.get('/api/compare?ids=99').status_code == 404
+        assert client.get('/api/compare?ids=1&startdate=2024-13-01').status_code == 400
+        assert client.get('/compare?ids=1&startdate=2024-13-01').status_code == 200
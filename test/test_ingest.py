@@ -0,0 +1,44 @@
+"""
+Unit tests of the price ingestion path (stock_analysis/ingest.py).
+"""
+import datetime
+import sqlite3
+
+from stock_analysis import app, db
+from stock_analysis.ingest import ingest_price, upgrade_database
+from stock_analysis.models import Stock, LatestPrice
+
+
+def test_upgrade_creates_and_fills_the_latest_prices(database):
+    stock = Stock(name='OLD', number_of_shares=10, ticker='OLDS')
+    db.session.add(stock)
+    db.session.commit()
+    ingest_price(stock.id, 10.0, datetime.datetime(2024, 1, 1, 10))
+    ingest_price(stock.id, 12.0, datetime.datetime(2024, 1, 2, 10))
+    LatestPrice.__table__.drop(db.engine)  # database created before the table existed
+    with db.engine.begin() as connection:
+        connection.execute(db.text('DROP TRIGGER diagram_latest_price'))
+
+    upgrade_database()
+
+    latest = LatestPrice.query.get(stock.id)
+    assert (latest.price, latest.previous_close) == (12.0, 10.0)
+    ingest_price(stock.id, 13.0, datetime.datetime(2024, 1, 2, 11))  # the trigger works again
+    assert LatestPrice.query.get(stock.id).price == 13.0
+
+
+def test_latest_price_follows_inserts_outside_the_orm(database):
+    stock = Stock(name='FEED', number_of_shares=10, ticker='FEED')
+    db.session.add(stock)
+    db.session.commit()
+    ingest_price(stock.id, 10.0, datetime.datetime(2024, 1, 1, 10))
+
+    path = app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+    with sqlite3.connect(path) as connection:  # e.g. another process
+        insert = 'INSERT INTO diagram (date, price, stock_id) VALUES (?, ?, ?)'
+        connection.execute(insert, ('2024-01-02 09:00:00.000000', 11.0, stock.id))
+        connection.execute(insert, ('2024-01-02 10:00:00.000000', 12.0, stock.id))
+        connection.execute(insert, ('2023-12-31 10:00:00.000000', 5.0, stock.id))  # back-filled history
+
+    latest = LatestPrice.query.get(stock.id)
+    assert (latest.price, latest.date, latest.previous_close) == (12.0, datetime.datetime(2024, 1, 2, 10), 10.0)
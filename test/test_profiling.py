@@ -0,0 +1,62 @@
+"""
+Unit tests of the sampling profiler of the requests (stock_analysis/profiling.py).
+"""
+import os
+
+import pytest
+from flask import g
+
+from stock_analysis import app
+from stock_analysis.caching import compress
+from stock_analysis.profiling import start_profile, stop_profile, RequestProfile, _local
+
+
+@pytest.fixture
+def profiled(database, tmp_path):
+    app.config.update(PROFILE_DIR=str(tmp_path), PROFILE_TOKEN='secret', PROFILE_SAMPLE_RATE=0.0)
+    yield tmp_path
+    app.config.update(PROFILE_DIR='profiles', PROFILE_TOKEN=None, PROFILE_SAMPLE_RATE=0.0)
+
+
+def get(url, **headers):
+    with app.test_client() as client:
+        return client.get(url, headers=headers)
+
+
+def test_profile_with_the_token(profiled):
+    response = get('/api/stocks', **{'X-Profile': 'secret'})
+    assert response.status_code == 200
+    assert os.listdir(profiled) == [response.headers['X-Profile-File']]
+    assert response.headers['X-Profile-File'].endswith('-api_stocks.collapsed')
+    assert response.headers['Server-Timing'].startswith('total;dur=')
+
+
+def test_no_profile_without_the_token(profiled):
+    for headers in ({}, {'X-Profile': 'wrong'}, {'X-Profile': 'secre'}):
+        response = get('/api/stocks', **headers)
+        assert 'X-Profile-File' not in response.headers and 'Server-Timing' not in response.headers
+    assert os.listdir(profiled) == []
+
+
+def test_teardown_stops_the_sampler(profiled):
+    with app.test_request_context('/', headers={'X-Profile': 'secret'}):
+        start_profile()
+        profile = g.profile
+        assert profile._sampler.is_alive()
+    # the request ended without `after_request`
+    assert not profile._sampler.is_alive()
+    assert _local.profile is None
+
+
+def test_profile_covers_the_compression():
+    handlers = app.after_request_funcs[None]  # they run in reverse order
+    assert handlers.index(stop_profile) < handlers.index(compress)
+
+
+def test_old_profiles_are_deleted(tmp_path):
+    names = []
+    for _ in range(4):
+        profile = RequestProfile(None, 0.001)
+        profile.stop()
+        names.append(profile.save(str(tmp_path), 'page', max_files=2))
+    assert sorted(os.listdir(tmp_path)) == names[-2:]
@@ -0,0 +1,55 @@
+"""
+Unit tests of the bulk provisioning of users (stock_analysis/provisioning.py).
+"""
+import csv
+import io
+
+import pytest
+
+from stock_analysis import app
+from stock_analysis.models import User
+
+CSV = 'username,email,password\nalice, alice@test.com ,secret\nbob,not-an-email,secret\n'
+
+
+@pytest.fixture
+def client(database):
+    app.config.update(LOGIN_DISABLED=True, PROVISIONING_TOKEN='token', PROVISIONING_MAX_ROWS=2)
+    with app.test_client() as client:
+        yield client
+    app.config.update(LOGIN_DISABLED=False, PROVISIONING_TOKEN=None, PROVISIONING_MAX_ROWS=500)
+
+
+def post(client, content, token='token'):
+    return client.post('/users/bulk', data=content, content_type='text/csv',
+                       headers={'X-Provisioning-Token': token})
+
+
+def test_bulk_users(client):
+    response = post(client, CSV)
+    assert response.status_code == 200
+    assert response.json['created'] == 1
+    assert [entry['status'] for entry in response.json['report']] == ['created', 'error']
+    assert User.query.filter_by(username='alice').one().email == 'alice@test.com'
+
+
+def test_bulk_users_requires_the_token(client):
+    assert post(client, CSV, token='wrong').status_code == 403
+    app.config['PROVISIONING_TOKEN'] = None
+    assert post(client, CSV, token='').status_code == 403
+    assert User.query.count() == 0
+
+
+def test_bulk_users_row_cap(client):
+    assert post(client, CSV + 'carol,carol@test.com,secret\n').status_code == 413
+    assert User.query.count() == 0
+
+
+def test_bulk_users_bad_input(client):
+    assert post(client, b'\xff\xfe').status_code == 400
+    response = client.post('/users/bulk', data={'file': (io.BytesIO(b'\xff\xfe'), 'users.csv')},
+                           headers={'X-Provisioning-Token': 'token'})
+    assert response.status_code == 400
+    too_long = 'x' * (csv.field_size_limit() + 1)  # csv.Error
+    assert post(client, f'username,email,password\nalice,alice@test.com,{too_long}\n').status_code == 400
+    assert User.query.count() == 0
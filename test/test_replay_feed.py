@@ -0,0 +1,45 @@
+"""
+Unit tests of the load-test feed (replay_feed.py).
+"""
+import datetime
+
+import pytest
+
+from replay_feed import csv_ticks, FeedStats, _percentiles
+
+
+class FakeStock:
+    def __init__(self, stock_id, ticker):
+        self.id = stock_id
+        self.ticker = ticker
+
+
+def test_percentiles_stay_within_the_samples():
+    assert _percentiles([]) == 'n/a'
+    assert _percentiles([0.002]) == 'p50=2.00ms max=2.00ms'
+    report = _percentiles([0.001, 0.002, 0.004, 0.008])
+    assert report == 'p50=3.00ms p95=7.40ms p99=7.88ms max=8.00ms'
+
+
+def test_visibility_lags():
+    stats = FeedStats()
+    stats.committed = [(2, 1.0), (1, 0.5), (3, 2.0)]
+    stats.observations = [(0.8, 1), (1.5, 2), (1.9, 3)]  # id 3 was seen before its emission time
+    assert stats.visibility_lags() == pytest.approx([0.3, 0.5, 0.0])
+    stats.observations = [(0.8, 1)]  # the reader stopped before seeing the others
+    assert stats.visibility_lags() == pytest.approx([0.3])
+
+
+def test_csv_ticks_skip_malformed_rows(tmp_path):
+    path = tmp_path / 'ticks.csv'
+    path.write_text('ticker,price,date\n'
+                    'aaa,10,2024-01-01 00:00:00\n'
+                    'AAA,abc,2024-01-01 00:00:00\n'
+                    'AAA,11,not a date\n'
+                    'AAA\n'
+                    'ZZZ,5,\n'  # unknown ticker, not an error
+                    'AAA,12,\n')
+    stats = FeedStats()
+    ticks = list(csv_ticks(str(path), [FakeStock(1, 'AAA')], stats))
+    assert ticks == [(1, 10.0, datetime.datetime(2024, 1, 1)), (1, 12.0, None)]
+    assert stats.input_errors == 3
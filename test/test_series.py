@@ -0,0 +1,23 @@
+"""
+Unit tests of the array-backed price series (stock_analysis/series.py).
+"""
+import datetime
+
+from stock_analysis import db
+from stock_analysis.models import Stock, Diagram
+from stock_analysis.series import PriceSeries
+
+
+def test_price_series_slices(database):
+    stock = Stock(name='B', number_of_shares=10, ticker='B')
+    db.session.add_all([stock,
+                        Diagram(date=datetime.datetime(2024, 1, 29), price=78, stock=stock),
+                        Diagram(date=datetime.datetime(2024, 2, 5), price=85, stock=stock)])
+    db.session.commit()
+
+    series = PriceSeries.load(stock.id)
+    assert series[-1] == (datetime.datetime(2024, 2, 5), 85)
+    tail = series[1:]
+    assert isinstance(tail, PriceSeries) and tail.stock_id == stock.id
+    assert list(tail) == [(datetime.datetime(2024, 2, 5), 85)]
+    assert len(series[::-1]) == 2 and series[::-1][0].price == 85
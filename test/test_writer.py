@@ -0,0 +1,102 @@
+"""
+Unit tests of the group-commit writer (stock_analysis/writer.py).
+"""
+import threading
+from concurrent.futures import TimeoutError
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from stock_analysis import app
+from stock_analysis.models import Stock
+from stock_analysis.writer import GroupCommitWriter, run_write, group_writer
+
+
+def add_stock(name):
+    def write(session):
+        stock = Stock(name=name, number_of_shares=100, ticker='TEST')
+        session.add(stock)
+        session.flush()
+        return stock.id
+    return write
+
+
+def stock_names():
+    return sorted(name for name, in Stock.query.with_entities(Stock.name))
+
+
+def test_writes_are_grouped_in_one_batch(database):
+    writer = GroupCommitWriter(app, max_batch=50, max_latency=0.5)
+    try:
+        futures = [writer.submit(add_stock(f'STOCK{i}')) for i in range(20)]
+        ids = [future.result(timeout=5) for future in futures]
+    finally:
+        writer.stop()
+
+    assert len(set(ids)) == 20
+    assert writer.batches == 1
+    assert writer.metrics()['batch_size']['max'] == 20
+    assert stock_names() == sorted(f'STOCK{i}' for i in range(20))
+
+
+def test_failing_write_is_isolated_from_its_batch(database):
+    run_write(add_stock('TAKEN'))
+    writer = GroupCommitWriter(app, max_batch=10, max_latency=0.5)
+    try:
+        first = writer.submit(add_stock('FIRST'))
+        duplicate = writer.submit(add_stock('TAKEN'))  # the name of a stock is unique
+        last = writer.submit(add_stock('LAST'))
+        assert first.result(timeout=5)
+        assert last.result(timeout=5)
+        with pytest.raises(IntegrityError):
+            duplicate.result(timeout=5)
+    finally:
+        writer.stop()
+
+    assert writer.errors == 1
+    assert stock_names() == ['FIRST', 'LAST', 'TAKEN']
+
+
+def test_cancelled_write_is_never_committed(database):
+    release = threading.Event()
+
+    def blocking(session):
+        release.wait(5)
+        return add_stock('BLOCKING')(session)
+
+    writer = GroupCommitWriter(app, max_batch=1, max_latency=0)
+    try:
+        blocked = writer.submit(blocking)
+        queued = writer.submit(add_stock('CANCELLED'))
+        assert queued.cancel()
+        release.set()
+        assert blocked.result(timeout=5)
+    finally:
+        writer.stop()
+
+    assert stock_names() == ['BLOCKING']
+
+
+def test_run_write_timeout_cancels_the_queued_write(database):
+    release = threading.Event()
+
+    def blocking(session):
+        release.wait(5)
+        return add_stock('BLOCKING')(session)
+
+    app.config['WRITE_BEHIND'] = True
+    app.config['WRITE_BEHIND_TIMEOUT'] = 0.1
+    group_writer.max_batch = 1
+    try:
+        blocked = group_writer.submit(blocking)
+        with pytest.raises(TimeoutError):
+            run_write(add_stock('TIMED OUT'))
+        release.set()
+        blocked.result(timeout=5)
+    finally:
+        group_writer.stop()
+        group_writer.max_batch = app.config['WRITE_BEHIND_MAX_BATCH']
+        app.config['WRITE_BEHIND'] = False
+        app.config['WRITE_BEHIND_TIMEOUT'] = 10
+
+    assert stock_names() == ['BLOCKING']